@@ -2,83 +2,514 @@
 import subprocess as sp
 import sys
 import time
-from datetime import datetime, timedelta
 import csv
 import json
 import os
 import re
 import io
-import math
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
 import shlex
 from pathlib import Path
 import contextlib
-from typing import TextIO, Annotated, Callable
+from typing import TextIO, Annotated, Callable, Iterator
 import functools
+import heapq
+import operator
+import threading
+import hashlib
+import socket
+import shutil
+import tempfile
+import uuid
+import math
+import select
+import signal
 
 import typer
 import psutil
-import pandas as pd
-from tabulate import tabulate
 from filelock import FileLock
 
+# Number of sampling ticks between rescans of the process tree where the
+# children of a process can't be read from /proc
+_CHILD_SCAN_TICKS = 5
+
+# With adaptive sampling, the sampling period of a job doubles every this
+# many samples, up to a maximum period in seconds
+_ADAPTIVE_BACKOFF_TICKS = 30
+_ADAPTIVE_MAX_INTERVAL = 4.0
+
+# Number of result rows collected before they are written out
+_CSV_BATCH_ROWS = 16
+
+# Large enough for any single CSV row sent by an intercept launcher
+_SINK_RECV_SIZE = 65536
+
+# Time in seconds after which the sink notices that it should stop
+_SINK_STOP_POLL = 0.2
+
+# Minimum time in seconds between two progress line updates
+_PROGRESS_MIN_PERIOD = 0.1
+
+# ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+_MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+_PAGESIZE = os.sysconf("SC_PAGE_SIZE") if sys.platform == "linux" else None
+
+
+def _rss(p: psutil.Process) -> int:
+    """Resident set size of a process in bytes"""
+    if _PAGESIZE is not None:
+        # second field of statm is the RSS in pages, much cheaper than
+        # going through memory_info()
+        try:
+            with open(f"/proc/{p.pid}/statm", "rb") as fh:
+                return int(fh.read().split()[1]) * _PAGESIZE
+        except FileNotFoundError:
+            pass
+    with p.oneshot():
+        return p.memory_info().rss
+
+
+# requires CONFIG_PROC_CHILDREN, which not every kernel is built with
+_PROC_CHILDREN = sys.platform == "linux" and os.path.exists(
+    f"/proc/self/task/{os.getpid()}/children"
+)
+
+
+def _descendants(root_pid: int) -> Iterator[int]:
+    """
+    PIDs of all descendants of a process. Only visits the process tree below
+    ``root_pid`` rather than every process on the system.
+    """
+    queue = [root_pid]
+    while queue:
+        pid = queue.pop()
+        try:
+            tids = os.listdir(f"/proc/{pid}/task")
+        except FileNotFoundError:
+            continue
+        for tid in tids:
+            try:
+                with open(f"/proc/{pid}/task/{tid}/children", "rb") as fh:
+                    pids = [int(c) for c in fh.read().split()]
+            except FileNotFoundError:
+                continue
+            yield from pids
+            queue.extend(pids)
+
+
+class _Tree:
+    """Memory usage of a process and all of its descendants."""
+
+    def __init__(self, process: psutil.Process):
+        self.process = process
+        self.mem = 0
+        self.max_mem = 0
+        self.samples = 0
+        self.next_sample = 0.0
+        self._children: dict[int, psutil.Process] = {}
+        self._rescan = True
+
+    def sample(self) -> None:
+        p = self.process
+        children = self._children
+
+        if _PROC_CHILDREN:
+            # only visits the job's own tree, cheap enough to do on every
+            # sample so that processes started late, e.g. by a compiler
+            # wrapper or during LTO, are seen right away
+            scanned = {}
+            for pid in _descendants(p.pid):
+                subp = children.get(pid)
+                if subp is None:
+                    try:
+                        subp = psutil.Process(pid)
+                    except psutil.NoSuchProcess:
+                        continue
+                scanned[pid] = subp
+            self._children = children = scanned
+        elif self._rescan or not children or self.samples % _CHILD_SCAN_TICKS == 0:
+            # psutil goes through every process on the system to find the
+            # children, so only do so every few samples unless the tree is
+            # still being set up or has changed
+            try:
+                for subp in p.children(recursive=True):
+                    children.setdefault(subp.pid, subp)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                pass
+            self._rescan = False
+        self.samples += 1
+
+        try:
+            mem = _rss(p)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            mem = 0
+        for pid, subp in list(children.items()):
+            try:
+                mem += _rss(subp)
+            except psutil.NoSuchProcess:
+                del children[pid]
+                self._rescan = True
+            except psutil.AccessDenied:
+                pass
+
+        self.mem = mem
+        self.max_mem = max(mem, self.max_mem)
+
+
+class Sampler:
+    """
+    Samples the memory usage of all registered processes from a single
+    background thread, so concurrent jobs don't each poll on their own.
+    """
+
+    def __init__(self, interval: float, adaptive: bool = False):
+        self.interval = interval
+        self.adaptive = adaptive
+        self._trees: dict[int, _Tree] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def __enter__(self) -> "Sampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._stopped.set()
+        self._wake.set()
+        self._thread.join()
+
+    def register(self, p: psutil.Process) -> _Tree:
+        tree = _Tree(p)
+        with self._lock:
+            self._trees[p.pid] = tree
+        # take the first sample right away to catch short jobs
+        self._wake.set()
+        return tree
+
+    def unregister(self, p: psutil.Process) -> int:
+        with self._lock:
+            tree = self._trees.pop(p.pid)
+        return tree.max_mem
+
+    def _period(self, tree: _Tree) -> float:
+        if not self.adaptive:
+            return self.interval
+        # The peak of a long running job rarely moves quickly, so back off
+        # while still sampling early transients at the full rate
+        # clamp the exponent, it would overflow on very long jobs and any
+        # realistic interval is past the cap long before
+        doublings = min(tree.samples // _ADAPTIVE_BACKOFF_TICKS, 32)
+        period = self.interval * 2**doublings
+        return max(self.interval, min(period, _ADAPTIVE_MAX_INTERVAL))
+
+    def _loop(self) -> None:
+        while not self._stopped.is_set():
+            self._wake.clear()
+            with self._lock:
+                trees = list(self._trees.values())
+            now = time.monotonic()
+            for tree in trees:
+                if now >= tree.next_sample:
+                    try:
+                        tree.sample()
+                    except (psutil.Error, OSError):
+                        # a failed sample must not take down the thread that
+                        # samples every other job as well
+                        pass
+                    tree.next_sample = now + self._period(tree)
+            next_sample = min(
+                (tree.next_sample for tree in trees), default=now + self.interval
+            )
+            self._wake.wait(max(next_sample - time.monotonic(), 0))
 
-def run(
+
+def _output_file(args: list[str]) -> str:
+    """Output file of a compiler or linker invocation, i.e. the argument to ``-o``"""
+    try:
+        return args[args.index("-o") + 1]
+    except (ValueError, IndexError):
+        raise ValueError(f"Could not extract output from {shlex.join(args)}") from None
+
+
+def _write_progress(progout: TextIO, tree: _Tree, elapsed: float, rp: str) -> None:
+    progout.write(
+        f"[{tree.mem/1e6:8.2f}M, max: {tree.max_mem/1e6:8.2f}M] [{elapsed:8.2f}s] - {rp}\r"
+    )
+    progout.flush()
+
+
+# Spawns a job from a bare interpreter and prints the peak RSS of the job's
+# processes. A child starts out with the RSS high-water mark of the process it
+# was spawned from, so spawning jobs from cmakeperf itself would put its own
+# memory usage into every measurement.
+_PEAK_LAUNCHER = """
+import os, resource, sys
+devnull = [(os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0), (os.POSIX_SPAWN_DUP2, 1, 2)]
+pid = os.posix_spawn("/bin/sh", ["/bin/sh", "-c", sys.argv[1]], os.environ, file_actions=devnull)
+os.waitpid(pid, 0)
+print(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+"""
+
+
+async def _wait_peak(command: str, directory: str) -> int:
+    """
+    Run a job to completion and return the peak RSS in bytes as accounted by
+    the kernel. This is the peak of the largest single process in the job,
+    not the sum over all of them, and never less than the RSS of a bare
+    Python interpreter the job is launched from.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-I",
+        "-S",
+        "-c",
+        _PEAK_LAUNCHER,
+        command,
+        cwd=directory,
+        stdout=sp.PIPE,
+        stderr=sp.DEVNULL,
+    )
+    out, _ = await proc.communicate()
+    try:
+        return int(out) * _MAXRSS_UNIT
+    except ValueError:
+        raise RuntimeError(f"Could not measure peak memory of {command}") from None
+
+
+@functools.cache
+def _cgroup_supported() -> bool:
+    """
+    Whether jobs can be put into their own transient systemd scope with
+    cgroup v2 memory accounting.
+    """
+    if sys.platform != "linux" or shutil.which("systemd-run") is None:
+        return False
+
+    # scopes are created by the user's service manager
+    runtime_dir = Path(os.environ.get("XDG_RUNTIME_DIR", f"/run/user/{os.getuid()}"))
+    if not (runtime_dir / "systemd" / "private").exists():
+        return False
+
+    try:
+        with open("/proc/self/cgroup") as fh:
+            path = next(line[3:].strip() for line in fh if line.startswith("0::"))
+    except (OSError, StopIteration):
+        return False
+
+    # memory.peak needs Linux 5.19 and the memory controller being enabled
+    # for the user's cgroups
+    return Path(f"/sys/fs/cgroup{path}/memory.peak").exists()
+
+
+async def _wait_cgroup_peak(command: str, directory: str) -> int | None:
+    """
+    Run a job in its own systemd scope and return the peak memory usage of
+    its cgroup in bytes. This covers all processes of the job, including
+    short lived ones, but also counts page cache charged to the job. Returns
+    None if the scope could not be created, in which case the job did not
+    run, and raises a RuntimeError if the job ran but the peak of its cgroup
+    could not be read.
+    """
+    with tempfile.TemporaryDirectory(prefix="cmakeperf") as tmp:
+        peak_file = Path(tmp) / "memory.peak"
+        # The scope's cgroup goes away with its last process, so read the
+        # peak from inside. Creating the file first marks that the job ran.
+        script = "\n".join(
+            [
+                f": > {shlex.quote(str(peak_file))}",
+                command,
+                "rc=$?",
+                'cat "/sys/fs/cgroup$(sed -n "s/^0:://p" /proc/self/cgroup)/memory.peak"'
+                f" > {shlex.quote(str(peak_file))}",
+                "exit $rc",
+            ]
+        )
+        proc = await asyncio.create_subprocess_exec(
+            "systemd-run",
+            "--user",
+            "--scope",
+            "--quiet",
+            "--collect",
+            f"--unit=cmakeperf-{uuid.uuid4().hex}",
+            "--property=MemoryAccounting=yes",
+            "sh",
+            "-c",
+            script,
+            cwd=directory,
+            stdout=sp.PIPE,
+            stderr=sp.STDOUT,
+        )
+        await proc.communicate()
+
+        if not peak_file.exists():
+            return None
+        try:
+            return int(peak_file.read_text())
+        except ValueError:
+            raise RuntimeError(
+                f"Could not read the cgroup peak memory of {command}"
+            ) from None
+
+
+def _clean_output(command: str, directory: str) -> None:
+    output = os.path.join(directory, _output_file(shlex.split(command)))
+    os.remove(output)
+
+
+async def _wait_sampled(
+    command: str,
+    file: str,
+    directory: str,
+    sampler: Sampler,
+    progout: TextIO | None,
+) -> int:
+    """
+    Run a job to completion while it is being sampled, and return the highest
+    combined RSS of all of its processes. Shows a live progress line on
+    ``progout`` if given.
+    """
+    proc = await asyncio.create_subprocess_shell(
+        command, cwd=directory, stdout=sp.PIPE, stderr=sp.STDOUT
+    )
+
+    start = time.monotonic()
+    try:
+        p = psutil.Process(proc.pid)
+    except psutil.NoSuchProcess:
+        # finished and reaped before we even got to look at it
+        p = None
+    tree = sampler.register(p) if p is not None else None
+
+    # the output is discarded, but has to be read so the job can't block on
+    # a full pipe
+    done = asyncio.ensure_future(proc.communicate())
+
+    if progout is not None and tree is not None:
+        rp = os.path.relpath(file)
+        # no point in redrawing faster than anyone can read
+        refresh = max(sampler.interval, _PROGRESS_MIN_PERIOD)
+        while True:
+            try:
+                await asyncio.wait_for(asyncio.shield(done), refresh)
+                break
+            except asyncio.TimeoutError:
+                pass
+            _write_progress(progout, tree, time.monotonic() - start, rp)
+        progout.write("\n")
+    else:
+        await done
+
+    return sampler.unregister(p) if p is not None else 0
+
+
+async def run_async(
     command: str,
     file: str,
     *,
     directory: str,
-    interval: float,
     progress: bool,
     progout: TextIO,
     post_clean: bool,
+    sampler: Sampler | None,
+    cgroup: bool = False,
     dry_run: bool = False,
-) -> tuple[str, float, timedelta]:
+) -> tuple[str, float | None, float]:
+    """
+    Run a single job and measure its time and memory usage. With ``cgroup``,
+    the job runs in its own cgroup and its peak memory is read from there.
+    Otherwise, or if that fails, the job is sampled. Without a sampler, only
+    the peak reported by the kernel when it exits is recorded. The memory
+    usage is None if it could not be measured.
+    """
     if dry_run:
-        return file, 0, timedelta(seconds=0)
+        return file, 0, 0.0
 
-    rp = os.path.relpath(file, os.getcwd())
+    start = time.monotonic()
+    try:
+        max_mem = await _wait_cgroup_peak(command, directory) if cgroup else None
 
-    p = psutil.Popen(
-        command, shell=True, cwd=directory, stdout=sp.PIPE, stderr=sp.STDOUT
-    )
+        if max_mem is None:
+            start = time.monotonic()
+            if sampler is None:
+                max_mem = await _wait_peak(command, directory)
+            else:
+                progress_active = progress and progout.isatty()
+                max_mem = await _wait_sampled(
+                    command,
+                    file,
+                    directory,
+                    sampler,
+                    progout if progress_active else None,
+                )
+    except RuntimeError as e:
+        # the job did run, don't give up on the others over its memory usage
+        print(f"{e}, not recording it", file=sys.stderr)
+        max_mem = None
 
-    max_mem = 0
-    start = datetime.now()
+    if post_clean:
+        _clean_output(command, directory)
 
-    while p.status() in (psutil.STATUS_RUNNING, psutil.STATUS_SLEEPING):
-        mem = p.memory_info().rss
-        for subp in p.children(recursive=True):
-            try:
-                mem += subp.memory_info().rss
-            except (psutil.NoSuchProcess, psutil.AccessDenied):
-                pass
+    # microsecond resolution is plenty and keeps the CSV output short
+    elapsed = round(time.monotonic() - start, 6)
+    return file, max_mem, elapsed
 
-        # in KB, go to MB
-        mem = mem
-        max_mem = max(mem, max_mem)
 
-        delta = datetime.now() - start
-        if progress and progout.isatty():
-            progout.write(
-                f"[{mem/1e6:8.2f}M, max: {max_mem/1e6:8.2f}M] [{delta.total_seconds():8.2f}s] - {rp}\r"
-            )
-            progout.flush()
-        time.sleep(interval)
+def run(
+    command: str,
+    file: str,
+    *,
+    directory: str,
+    progress: bool,
+    progout: TextIO,
+    post_clean: bool,
+    sampler: Sampler | None,
+    cgroup: bool = False,
+    dry_run: bool = False,
+) -> tuple[str, float | None, float]:
+    """Blocking version of :func:`run_async`, for running a single job"""
+    return asyncio.run(
+        run_async(
+            command,
+            file,
+            directory=directory,
+            progress=progress,
+            progout=progout,
+            post_clean=post_clean,
+            sampler=sampler,
+            cgroup=cgroup,
+            dry_run=dry_run,
+        )
+    )
 
-    p.wait()
 
-    if progress and progout.isatty():
-        progout.write("\n")
+def _file_matcher(filter: str, exclude: str) -> Callable[[str], bool]:
+    """
+    Returns a function that tells whether a file name is selected by
+    ``filter`` and not by ``exclude``, both matched at the start of the name.
+    """
+    filter_ex = re.compile(filter)
+    exclude_ex = re.compile(exclude)
 
-    if post_clean:
-        m = re.search(r"-o ?([\w\/\.]*)", command)
-        assert m is not None, "Could not extract output"
-        output = os.path.join(directory, m.group(1))
-        os.remove(output)
+    # Plain patterns can be fused into one, so each file only goes through
+    # one match call. Global inline flags, group names and backreferences
+    # don't survive being combined like this.
+    if all(ex.groups == 0 and ex.flags == re.UNICODE for ex in (filter_ex, exclude_ex)):
+        fused = re.compile(f"(?=(?:{filter}))(?!(?:{exclude}))")
+        return lambda f: fused.match(f) is not None
+
+    return lambda f: filter_ex.match(f) is not None and exclude_ex.match(f) is None
 
-    delta = datetime.now() - start
-    return file, max_mem, delta
+
+def _load_compile_db(fh: TextIO) -> list[dict]:
+    # orjson parses large compilation databases a lot faster, use it if it's there
+    try:
+        import orjson
+    except ImportError:
+        return json.load(fh)
+    return orjson.loads(fh.read())
 
 
 app = typer.Typer(no_args_is_help=True)
@@ -102,15 +533,43 @@ def collect(
     interval: Annotated[
         float, typer.Option(help="Sampling interval to collect memory usage at")
     ] = 0.5,
+    adaptive_interval: Annotated[
+        bool,
+        typer.Option(
+            help="Sample long running jobs less frequently, "
+            f"up to every {_ADAPTIVE_MAX_INTERVAL:g}s"
+        ),
+    ] = False,
+    peak_only: Annotated[
+        bool,
+        typer.Option(
+            help="Don't sample, record the peak RSS of the largest process of "
+            "each job as reported by the kernel when it exits"
+        ),
+    ] = False,
+    cgroup: Annotated[
+        bool,
+        typer.Option(
+            help="Run each job in its own systemd scope and record the peak "
+            "memory of its cgroup, including page cache. Needs cgroup v2, "
+            "falls back to sampling otherwise"
+        ),
+    ] = False,
     jobs: Annotated[int, typer.Option(help="Number of concurrent jobs to run")] = 1,
     post_clean: Annotated[
         bool, typer.Option(help="Clean up after the compilation")
     ] = False,
 ):
-    filter_ex = re.compile(filter)
-    exclude_ex = re.compile(exclude)
+    selected = _file_matcher(filter, exclude)
+
+    if cgroup and not _cgroup_supported():
+        print(
+            "cgroup v2 memory accounting is not available, falling back to sampling",
+            file=sys.stderr,
+        )
+        cgroup = False
 
-    commands = json.load(compile_db)
+    commands = _load_compile_db(compile_db)
 
     with contextlib.ExitStack() as stack:
         out_fh = io.StringIO()  # we will throw this away
@@ -129,50 +588,78 @@ def collect(
 
         writer.writerow(["file", "max_rss", "time", "type"])
 
-        with ThreadPoolExecutor(jobs) as ex:
-            futures = []
-            try:
-                for item in commands:
-                    command = item["command"]
-                    file = item["file"]
-                    directory = item["directory"]
+        sampler = (
+            stack.enter_context(Sampler(interval, adaptive=adaptive_interval))
+            if not peak_only
+            else None
+        )
 
-                    if not filter_ex.match(file):
-                        continue
+        rows: list[list] = []
+
+        def write_rows():
+            writer.writerows(rows)
+            rows.clear()
+            out_fh.flush()
+
+        cwd = os.getcwd()
+
+        async def run_all():
+            # limits concurrency, jobs start in the order of the database
+            slots = asyncio.Semaphore(jobs)
+
+            async def job(command: str, file: str, directory: str):
+                async with slots:
+                    return await run_async(
+                        command,
+                        file,
+                        directory=directory,
+                        progress=jobs == 1,
+                        progout=progout,
+                        post_clean=post_clean,
+                        sampler=sampler,
+                        cgroup=cgroup,
+                    )
 
-                    if exclude_ex.match(file):
-                        continue
+            tasks = [
+                asyncio.create_task(
+                    job(item["command"], item["file"], item["directory"])
+                )
+                for item in commands
+                if selected(item["file"])
+            ]
+
+            # without sampling there's no live progress line to look at
+            show_done = jobs > 1 or not progout.isatty() or sampler is None or cgroup
+            total = len(tasks)
+            done_line = (
+                f"[{{cur:>{len(str(total))}}}/{total}, {{perc:5.1f}}%] "
+                "[{mem:8.2f}M] [{elapsed:8.2f}s] - {rp}\n"
+            )
 
-                    futures.append(
-                        ex.submit(
-                            run,
-                            command,
-                            file,
-                            directory=directory,
-                            interval=interval,
-                            progress=jobs == 1,
-                            progout=progout,
-                            post_clean=post_clean,
+            for idx, f in enumerate(asyncio.as_completed(tasks)):
+                file, max_mem, elapsed = await f
+                rp = os.path.relpath(file, cwd)
+                rows.append([rp, max_mem, elapsed, "compile"])
+                if len(rows) >= _CSV_BATCH_ROWS:
+                    write_rows()
+                if show_done:
+                    progout.write(
+                        done_line.format(
+                            cur=idx + 1,
+                            perc=(idx + 1) / total * 100,
+                            mem=max_mem / 1e6 if max_mem is not None else math.nan,
+                            elapsed=elapsed,
+                            rp=rp,
                         )
                     )
+                    progout.flush()
 
-                for idx, f in enumerate(as_completed(futures)):
-                    file, max_mem, delta = f.result()
-                    rp = os.path.relpath(file, os.getcwd())
-                    writer.writerow([rp, max_mem, delta.total_seconds(), "compile"])
-                    if jobs > 1 or not progout.isatty():
-                        perc = (idx + 1) / len(futures) * 100
-                        cur = str(idx + 1).rjust(math.ceil(math.log10(len(futures))))
-                        progout.write(
-                            f"[{cur}/{len(futures)}, {perc:5.1f}%] [{max_mem/1e6:8.2f}M] [{delta.total_seconds():8.2f}s] - {rp}\n"
-                        )
-                        progout.flush()
-
-            except KeyboardInterrupt:
-                print("Ctrl+C")
-                for f in futures:
-                    f.cancel()
-                ex.shutdown()
+        try:
+            asyncio.run(run_all())
+        except KeyboardInterrupt:
+            print("Ctrl+C")
+        finally:
+            write_rows()
 
 
 @app.command("print")
@@ -189,33 +676,42 @@ def fn_print(
     filter: Annotated[str, typer.Option(help="Filter input files by regex")] = ".*",
     exclude: Annotated[str, typer.Option(help="Exclude input files by regex")] = "$^",
 ):
-    df = pd.read_csv(data_file)
-    df.max_rss /= 1e6
+    # only needed here, keep it off the import path of the intercept launchers
+    from tabulate import tabulate
 
-    filter_ex = re.compile(filter)
-    exclude_ex = re.compile(exclude)
-    mask = [
-        filter_ex.match(f) is None or exclude_ex.match(f) is not None for f in df.file
-    ]
-    df.drop(df[mask].index.tolist(), inplace=True)
-    filenames = df.file[df.type == "compile"]
+    selected = _file_matcher(filter, exclude)
 
-    if len(filenames) == 1:
-        filenames = [os.path.basename(filenames.iloc[0])]
-    else:
-        prefix = os.path.commonprefix(list(filenames))
-        filenames = [f[len(prefix) :] if f != prefix else f for f in filenames]
+    with data_file.open(newline="") as fh:
+        rows = [r for r in csv.DictReader(fh) if selected(r["file"])]
 
-    df.loc[df.type == "compile", "file"] = filenames
+    compiles = [r for r in rows if r["type"] == "compile"]
 
-    df.drop(columns="type", inplace=True)
+    if len(compiles) == 1:
+        compiles[0]["file"] = os.path.basename(compiles[0]["file"])
+    else:
+        prefix = os.path.commonprefix([r["file"] for r in compiles])
+        for r in compiles:
+            if r["file"] != prefix:
+                r["file"] = r["file"][len(prefix) :]
+
+    # max_rss is left empty for jobs whose memory usage could not be measured
+    table = [
+        (
+            r["file"],
+            float(r["max_rss"]) / 1e6 if r["max_rss"] else None,
+            float(r["time"]),
+        )
+        for r in rows
+    ]
 
-    mem = df.sort_values(by="max_rss", ascending=False)
-    time = df.sort_values(by="time", ascending=False)
+    mem = heapq.nlargest(
+        number, (r for r in table if r[1] is not None), key=operator.itemgetter(1)
+    )
+    time = heapq.nlargest(number, table, key=operator.itemgetter(2))
 
     print(
         tabulate(
-            [list(r) for _, r in mem.head(number).iterrows()],
+            mem,
             headers=("file", "max_rss [M]", "time [s]"),
             floatfmt=("", ".2f", ".2f"),
         )
@@ -223,13 +719,100 @@ def fn_print(
     print()
     print(
         tabulate(
-            [list(r) for _, r in time.head(number).iterrows()],
+            time,
             headers=("file", "max_rss [M]", "time [s]"),
             floatfmt=("", ".2f", ".2f"),
         )
     )
 
 
+def _sink_address(output_csv: Path) -> str:
+    """Abstract unix socket of the sink that writes to ``output_csv``"""
+    digest = hashlib.sha1(str(output_csv.resolve()).encode()).hexdigest()[:16]
+    return f"\0cmakeperf-{digest}"
+
+
+def _send_to_sink(output_csv: Path, row: str) -> bool:
+    """Hand a CSV row to a running sink, returns False if there is none"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(row.encode(), _sink_address(output_csv))
+    except (OSError, AttributeError):
+        # no sink listening, or no (abstract) unix sockets on this platform
+        return False
+    return True
+
+
+@app.command()
+def sink(
+    output: Annotated[
+        Path,
+        typer.Option(
+            "--output",
+            "-o",
+            envvar="CMAKEPERF_OUTPUT_CSV",
+            dir_okay=False,
+            help="Output CSV file, must match the one the intercept launchers use",
+        ),
+    ] = Path("cmakeperf.csv"),
+):
+    """
+    Receive results from cmakeperf-intercept / cmakeperf-intercept-ld and
+    write them to a single CSV file, so concurrent launchers don't have to
+    serialize on a file lock. Stop with Ctrl+C.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.bind(_sink_address(output))
+        except OSError as e:
+            raise ValueError(f"Could not start sink for {output}: {e}") from e
+
+        with output.open("a+", newline="") as fh:
+            if fh.tell() == 0:
+                csv.writer(fh, delimiter=",").writerow(
+                    ["file", "max_rss", "time", "type"]
+                )
+                fh.flush()
+
+            stopping = False
+
+            def stop(signum, frame) -> None:
+                nonlocal stopping
+                stopping = True
+
+            def write_pending() -> None:
+                rows = []
+                try:
+                    while row := sock.recv(_SINK_RECV_SIZE, socket.MSG_DONTWAIT):
+                        rows.append(row)
+                except BlockingIOError:
+                    pass
+                fh.write(b"".join(rows).decode())
+                fh.flush()
+
+            # Launchers consider their row saved once it is sent, so Ctrl+C
+            # must not interrupt the sink between receiving and writing rows
+            handler = signal.signal(signal.SIGINT, stop)
+            print(f"Writing to {output}, Ctrl+C to stop")
+            try:
+                while not stopping:
+                    if select.select([sock], [], [], _SINK_STOP_POLL)[0]:
+                        write_pending()
+            finally:
+                signal.signal(signal.SIGINT, handler)
+
+            # refuse new rows, so launchers fall back to the file lock, and
+            # write out those that are still queued
+            sock.shutdown(socket.SHUT_RD)
+            write_pending()
+
+
+def _csv_row(*values) -> str:
+    buf = io.StringIO()
+    csv.writer(buf, delimiter=",").writerow(values)
+    return buf.getvalue()
+
+
 def _run_intercept(*args, type: str, **kwargs):
     output_csv = Path(
         os.environ.get("CMAKEPERF_OUTPUT_CSV", Path.cwd() / "cmakeperf.csv")
@@ -237,18 +820,53 @@ def _run_intercept(*args, type: str, **kwargs):
     lock_path = output_csv.with_suffix(".lock")
 
     interval = float(os.environ.get("CMAKEPERF_INTERVAL", kwargs.pop("interval", 0.5)))
+    adaptive = os.environ.get("CMAKEPERF_ADAPTIVE_INTERVAL", "0") == "1"
+    cgroup = os.environ.get("CMAKEPERF_CGROUP", "0") == "1" and _cgroup_supported()
+
+    if os.environ.get("CMAKEPERF_PEAK_ONLY", "0") == "1":
+        rp, max_mem, elapsed = run(*args, sampler=None, cgroup=cgroup, **kwargs)
+    else:
+        with Sampler(interval, adaptive=adaptive) as sampler:
+            rp, max_mem, elapsed = run(*args, sampler=sampler, cgroup=cgroup, **kwargs)
 
-    rp, max_mem, delta = run(*args, interval=interval, **kwargs)
+    row = _csv_row(rp, max_mem, elapsed, type)
+
+    if _send_to_sink(output_csv, row):
+        return
+
+    # Leave the row next to the output so that whichever launcher gets the
+    # lock first commits it along with its own, instead of every launcher
+    # queueing up to write a single row. The rename makes sure only complete
+    # rows are ever picked up.
+    part = output_csv.with_name(f"{output_csv.name}.{os.getpid()}.part")
+    tmp = part.with_suffix(".tmp")
+    # keep the csv module's line endings as they are, on writing and reading
+    with tmp.open("w", newline="") as fh:
+        fh.write(row)
+    tmp.replace(part)
 
     lock = FileLock(lock_path)
 
     with lock:
+        parts = sorted(output_csv.parent.glob(f"{output_csv.name}.*.part"))
+        if not parts:
+            # someone else already committed our row
+            return
+        rows = []
+        for p in parts:
+            with p.open(newline="") as fh:
+                rows.append(fh.read())
+
         exists = output_csv.exists()
-        with output_csv.open("a+") as fh:
-            writer = csv.writer(fh, delimiter=",")
+        with output_csv.open("a+", newline="") as fh:
             if not exists:
-                writer.writerow(["file", "max_rss", "time", "type"])
-            writer.writerow([rp, max_mem, delta.total_seconds(), type])
+                csv.writer(fh, delimiter=",").writerow(
+                    ["file", "max_rss", "time", "type"]
+                )
+            fh.writelines(rows)
+
+        for p in parts:
+            p.unlink()
 
 
 def with_args(func: Callable[[list[str]], None]):
@@ -287,10 +905,7 @@ def intercept(args: list[str]):
 def intercept_ld(args: list[str]):
     command = shlex.join(args)
 
-    index = args.index("-o")
-    file = args[index + 1]
-
-    assert file is not None
+    file = _output_file(args)
 
     _run_intercept(
         command,